@@ -12,6 +12,8 @@ __email__ = "info@xlvisuals.com"
 
 import os
 import sys
+import stat
+import errno
 import shutil
 import signal
 import threading
@@ -19,45 +21,200 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog, messagebox, scrolledtext
 from helpers import Helpers
+from itertools import zip_longest
 from queue import Queue
 from threading import Thread
-from time import sleep, time
+from time import time
+
+# tells a worker thread to exit
+_SENTINEL = object()
 
 
 class ThreadedCopy:
 
+    # files above this size don't stay in the page cache after copying
+    large_file_size = 67108864
+    # files up to this size are copied without readahead hints and preallocation
+    small_file_size = 1048576
+    # libc fallocate(), loaded on first use
+    _fallocate = None
+
     def __init__(self):
         self._stopping = False
         self._file_queue = Queue()
         self.total_file_count = 0
-        self.copied_file_count = 0
-        self.lock = threading.Lock()
+        # one counter per worker thread, so no lock is needed to update them
+        self._copied_counts = []
+        self._identical_counts = []
+
+    @property
+    def copied_file_count(self):
+        return sum(self._copied_counts)
 
-    def _worker_func(self):
+    @property
+    def identical_file_count(self):
+        return sum(self._identical_counts)
+
+    def _worker_func(self, index):
+        get = self._file_queue.get
+        task_done = self._file_queue.task_done
         while True:
+            item = get()
             try:
-                source, dest = self._file_queue.get()
-                if source and dest and not self._stopping:
-                    self.log(f"Copying {source}")
-                    shutil.copy(source, dest, follow_symlinks=False)
-                    with self.lock:
-                        self.copied_file_count += 1
-                else:
+                if item is _SENTINEL or self._stopping:
                     break
+                source, dest, verify = item
+                dest_file = os.path.join(dest, os.path.basename(source)) if verify else None
+                if verify and self._same_content(source, dest_file):
+                    self.log(f"Skipping '{source}': destination '{dest_file}' is identical")
+                    self._identical_counts[index] += 1
+                else:
+                    if verify:
+                        self.log(f"Destination '{dest_file}' differs from source")
+                    self.log(f"Copying {source}")
+                    self._fast_copy(source, dest)
+                    self._copied_counts[index] += 1
             except Exception as e:
                 self.log(f"Error copying: {str(e)}")
             finally:
-                self._file_queue.task_done()
-
-    def put(self, source, dest):
-        self._file_queue.put([source, dest])
+                # the item must always be released, or wait() blocks forever
+                task_done()
+
+    @staticmethod
+    def _fast_copy(source, dest_dir):
+        """
+        Copies source file into dest_dir and keeps the data inside the kernel where possible.
+        Only Linux supports copy_file_range/sendfile between regular files, other platforms use shutil.copy
+        (fcopyfile on macOS, a buffered read/write loop on Windows).
+        """
+        if not sys.platform.startswith("linux"):
+            return shutil.copy(source, dest_dir, follow_symlinks=False)
+
+        dest = os.path.join(dest_dir, os.path.basename(source))
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            st = os.fstat(src_fd)
+            dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            try:
+                if st.st_size <= ThreadedCopy.small_file_size:
+                    # small pictures: reflink, hints and preallocation would cost more syscalls than the copy itself
+                    ThreadedCopy._copy_fd(src_fd, dst_fd, st.st_size, read_to_end=False)
+                # a reflink on the same filesystem shares the data blocks and moves nothing
+                elif not (os.fstat(dst_fd).st_dev == st.st_dev and ThreadedCopy._try_reflink(src_fd, dst_fd)):
+                    # card readahead for the copy, then drop the pages: recordings are not read again
+                    os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    ThreadedCopy._preallocate(dst_fd, st.st_size)
+                    ThreadedCopy._copy_fd(src_fd, dst_fd, st.st_size)
+                    os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                    if st.st_size > ThreadedCopy.large_file_size:
+                        # dirty pages can only be dropped once they are written
+                        os.fdatasync(dst_fd)
+                        os.posix_fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                # shutil.copy copies permission bits as well
+                os.fchmod(dst_fd, stat.S_IMODE(st.st_mode))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        return dest
+
+    @staticmethod
+    def _try_reflink(src_fd, dst_fd):
+        """
+        Clones src_fd into dst_fd with the FICLONE ioctl (btrfs, xfs, ...).
+        Returns False if the filesystem can't do it.
+        """
+        import fcntl
+        try:
+            fcntl.ioctl(dst_fd, 0x40049409, src_fd)
+            return True
+        except OSError as e:
+            if e.errno not in (errno.ENOTTY, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS, errno.EPERM):
+                raise
+        return False
+
+    @staticmethod
+    def _preallocate(fd, size):
+        """
+        Reserves the blocks for the whole file up front, so concurrent copies don't interleave their extents.
+        Calls fallocate() directly because posix_fallocate() writes every block on filesystems without support (exFAT).
+        FALLOC_FL_KEEP_SIZE leaves the file size alone: an interrupted copy must not look complete.
+        """
+        if size <= 0:
+            return
+        if ThreadedCopy._fallocate is None:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+            fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            ThreadedCopy._fallocate = fallocate
+        # failures (e.g. EOPNOTSUPP on FAT) are ignored, the copy just runs without preallocation
+        ThreadedCopy._fallocate(fd, 1, 0, size)
+
+    @staticmethod
+    def _copy_fd(src_fd, dst_fd, size, read_to_end=True):
+        """
+        Copies size bytes. With read_to_end, also copies whatever was appended to src_fd since fstat(),
+        otherwise the read/write loop only runs if the kernel copy left bytes over.
+        """
+        remaining = size
+        if hasattr(os, "copy_file_range"):
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError as e:
+                # e.g. kernel too old, different filesystems or filesystem without support
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+        if remaining > 0:
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(dst_fd, src_fd, None, remaining)
+                    if sent == 0:
+                        break
+                    remaining -= sent
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL):
+                    raise
+        if not read_to_end and remaining <= 0:
+            return
+        # Last resort, and also catches files that grew since fstat()
+        while True:
+            buf = os.read(src_fd, 1048576)
+            if not buf:
+                break
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(dst_fd, view):]
+
+    @staticmethod
+    def _same_content(file1, file2, bufsize=1048576):
+        """
+        Compares two files chunk by chunk and stops at the first difference.
+        """
+        with open(file1, 'rb') as fd1, open(file2, 'rb') as fd2:
+            while True:
+                buf1 = fd1.read(bufsize)
+                buf2 = fd2.read(bufsize)
+                if buf1 != buf2:
+                    return False
+                if not buf1:
+                    return True
+
+    def put(self, source, dest, verify=False):
+        self._file_queue.put((source, dest, verify))
 
     def start(self, max_threads=6):
         self._threads = []
         for i in range(max_threads):
             if not self._stopping:
-                t = Thread(target=self._worker_func, daemon=True)
+                t = Thread(target=self._worker_func, args=(len(self._copied_counts),), daemon=True)
                 if t:
+                    self._copied_counts.append(0)
+                    self._identical_counts.append(0)
                     t.start()
                     self._threads.append(t)
         return self._threads
@@ -67,7 +224,7 @@ class ThreadedCopy:
         if self._threads:
             for i in self._threads:
                 # add one per thread
-                self._file_queue.put((None, None))
+                self._file_queue.put(_SENTINEL)
             for t in self._threads:
                 t.join(2)
         return True
@@ -76,70 +233,101 @@ class ThreadedCopy:
         self._file_queue.join()
         return True
 
-    def init(self, sources, target, startswith=("VID_", "PIC_"), log_callback=None):
+    def init(self, sources, target, startswith=("VID_", "PIC_"), log_callback=None, verify=False):
         if log_callback:
             self.log = log_callback
         else:
             self.log = print
 
         self.log("Collecting source subfolders")
-        folders = []
+        folders = set()
         for s in sources:
-            for p in startswith:
-                subdirs = Helpers.get_subdirs(s, p)
-                for d in subdirs:
-                    if d not in folders:
-                        folders.append(d)
+            # str.startswith accepts the whole prefix tuple, so each card is scanned only once
+            folders.update(Helpers.get_subdirs(s, startswith, sort=False))
+        folders = sorted(folders)
 
         self.log("Creating target folders")
+        target_folders = []
         for f in folders:
+            p = os.path.join(target, f)
             try:
-                p = os.path.abspath(os.path.join(target, f))
-                if not os.path.exists(p):
-                    os.mkdir(p)
-            except FileExistsError:
-                pass
+                os.makedirs(p, exist_ok=True)
+                target_folders.append(f)
+            except OSError as e:
+                # e.g. a file with the folder's name already exists in the target
+                self.log(f"Error creating target folder '{p}': {str(e)}")
 
         self.log("Preparing files")
-        for f in folders:
+        for f in target_folders:
+            # one list of (source, destination) per card
+            card_files = []
+            # computed once per folder, the loops below only concatenate strings
+            destination = os.path.abspath(os.path.join(target, f)) + os.path.sep
+            # sizes of files already in the target folder, read with one directory scan
+            destination_sizes = {}
+            try:
+                with os.scandir(destination) as it:
+                    for entry in it:
+                        if entry.is_file(follow_symlinks=False):
+                            destination_sizes[entry.name] = entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                pass
             for s in sources:
+                files = []
+                card_files.append(files)
                 try:
                     source_filenames = []
                     source = os.path.abspath(os.path.join(s, f))
-                    destination = os.path.abspath(os.path.join(target, f)) + os.path.sep
+                    source_sep = source + os.path.sep
                     try:
                         # program the loop explicit in case some recording subfolders are missing from some cards
-                        for sf in os.listdir(source):
-                            sf_path = os.path.join(source, sf)
-                            if os.path.isfile(sf_path):
-                                # only filename, not path
-                                source_filenames.append(sf)
+                        with os.scandir(source) as it:
+                            for entry in it:
+                                if entry.is_file(follow_symlinks=False):
+                                    # only filename, not path, and the size from the directory entry
+                                    source_filenames.append((entry.name, entry.stat(follow_symlinks=False).st_size))
                     except FileNotFoundError as e:
                         self.log(f"Warning. Folder '{source}' is missing.")
-                    for filename in source_filenames:
-                        source_file = os.path.abspath(os.path.join(source, filename))
-                        destination_file = os.path.abspath(os.path.join(destination, filename))
+                    for filename, source_size in source_filenames:
+                        source_file = source_sep + filename
+                        destination_file = destination + filename
+                        same_size = False
                         try:
-                            if os.path.exists(destination_file):
-                                if os.path.getsize(destination_file) == os.path.getsize(source_file):
+                            destination_size = destination_sizes.get(filename)
+                            if destination_size is not None:
+                                if destination_size == source_size and verify:
+                                    # compare content in the copy threads, copy again if it differs
+                                    same_size = True
+                                elif destination_size == source_size:
                                     self.log(f"Skipping '{source_file}': destination '{destination_file}' already exists")
                                     continue
                                 else:
                                     # file sizes don't match -> delete destination before copying
                                     self.log("Deleting '{}'".format(destination_file))
                                     os.remove(destination_file)
-                            self.put(source_file, destination)
-                            self.total_file_count += 1
+                                    destination_sizes.pop(filename, None)
+                            files.append((source_file, destination, same_size))
                         except Exception as e:
                             self.log("Error copying '{}': {}".format(source_file, e))
                 except Exception as e:
                     self.log(f"Error preparing copy for {s}: {str(e)}")
+            # Interleave the cards so that concurrent workers read from different cards
+            # instead of all queueing up on the same device.
+            for batch in zip_longest(*card_files):
+                for item in batch:
+                    if item:
+                        self.put(*item)
+                        self.total_file_count += 1
         self.log(f"Prepared {self.total_file_count} files")
 
 
 
 class BatchCopy():
 
+    # drive -> time it was last found to be a card, shared by all windows
+    _card_cache = {}
+    card_cache_ttl = 5
+
     def __init__(self):
         # self.button_cancel = None
         self.button_start = None
@@ -155,13 +343,17 @@ class BatchCopy():
         self.target_button = None
         self.target_entry = None
         self.target_dir_value = None
+        self.verify_value = None
 
         self.copying = False
         self._lock = threading.Lock()
         self._unprocessed_logs = []
+        self._log_event_pending = False
         self._can_quit = True
         self._threadedcopy = None
         self._copy_thread = None
+        self._find_cards_thread = None
+        self._found_cards = []
 
     def init(self):
         self._init_tk()
@@ -188,8 +380,10 @@ class BatchCopy():
 
         self.root.bind("<<log_callback>>", self._on_log_callback)
         self.root.bind("<<done_callback>>", self._on_done_callback)
+        self.root.bind("<<find_cards_callback>>", self._on_find_cards_callback)
         self.root.protocol("WM_DELETE_WINDOW", self._on_quit)
         self.target_dir_value = tk.StringVar()
+        self.verify_value = tk.BooleanVar(value=False)
 
     def _init_ttk(self):
         # Load and set theme
@@ -234,13 +428,11 @@ class BatchCopy():
                 messagebox.showerror(title="Error", message="Target directory must not be same as or below source directory.")
                 return
             else:
-                recordings = Helpers.get_subdirs(sdir, "VID_")
+                recordings = Helpers.get_subdirs(sdir, ("VID_", "PIC_"), sort=False)
                 # check if it has recordings subdirs, if not show warning.
                 self.source_listbox.insert(self.source_listbox.size(), sdir)
                 if not recordings:
-                    recordings = Helpers.get_subdirs(sdir, "PIC_")
-                    if not recordings:
-                        messagebox.showwarning(title="Warning", message="The selected directory has no VID_ or PIC_ subdirectories.")
+                    messagebox.showwarning(title="Warning", message="The selected directory has no VID_ or PIC_ subdirectories.")
 
     def _on_delete_source_dir(self):
         try:
@@ -270,23 +462,59 @@ class BatchCopy():
 
 
     def _on_find_cards(self):
-        file = ".pro_suc"
-        drives = Helpers.get_drives()
-        all_cards = []
-        new_cards = []
-        for fdir in drives:
+        # Checking drives can block on unresponsive (network) mounts, so don't do it in the gui thread.
+        if self._find_cards_thread and self._find_cards_thread.is_alive():
+            self.log("Still searching for cards ...")
+            return
+        self._find_cards_thread = threading.Thread(target=self._find_cards, daemon=True)
+        self._find_cards_thread.start()
+
+    def _find_cards(self):
+        cards = []
+        for fdir in Helpers.get_drives():
             try:
                 if fdir.endswith('/') or fdir.endswith('\\'):
                     fdir = fdir[:-1]
-                proc_file = os.path.join(fdir, file)
-                if os.path.isfile(proc_file):
-                    all_cards.append(fdir)
-                    if fdir not in self._get_list_entries():
-                        new_cards.append(fdir)
+                if self._is_card(fdir):
+                    cards.append(fdir)
             except:
                 pass
-        if new_cards:
-            for card in new_cards:
+        try:
+            self._lock.acquire()
+            self._found_cards = cards
+        finally:
+            self._lock.release()
+        try:
+            self.root.event_generate("<<find_cards_callback>>")
+        except Exception as e:
+            print("Error in _find_cards(): ", str(e))
+
+    def _is_card(self, fdir):
+        now = time()
+        found = BatchCopy._card_cache.get(fdir)
+        if found and now - found < BatchCopy.card_cache_ttl:
+            return True
+        try:
+            is_card = stat.S_ISREG(os.stat(os.path.join(fdir, ".pro_suc")).st_mode)
+        except OSError:
+            is_card = False
+        # only cards are cached, so a card inserted right after a search is found by the next one
+        if is_card:
+            BatchCopy._card_cache[fdir] = now
+        else:
+            BatchCopy._card_cache.pop(fdir, None)
+        return is_card
+
+    def _on_find_cards_callback(self, event=None):
+        try:
+            self._lock.acquire()
+            all_cards = self._found_cards
+            self._found_cards = []
+        finally:
+            self._lock.release()
+        entries = self._get_list_entries()
+        for card in all_cards:
+            if card not in entries:
                 self.source_listbox.insert(self.source_listbox.size(), card)
         if not all_cards:
             messagebox.showwarning(title="Info", message="No new Pro 2 cards found.")
@@ -336,6 +564,7 @@ class BatchCopy():
 
             sources_dirs = self._get_list_entries()
             target_dir = self.target_dir_value.get()
+            verify = self.verify_value.get()
             if not sources_dirs:
                 messagebox.showerror(title="Error", message="No source selected.")
                 return
@@ -365,15 +594,19 @@ class BatchCopy():
 
             def start_copy():
                 self._threadedcopy = ThreadedCopy()
-                self._threadedcopy.init(sources_dirs, target_dir, ("VID_", "PIC_"), self.log_callback)
+                self._threadedcopy.init(sources_dirs, target_dir, ("VID_", "PIC_"), self.log_callback, verify)
                 if self._threadedcopy.total_file_count > 0:
                     start = time()
-                    self._threadedcopy.start(len(sources_dirs))
+                    # two streams per card keep each card busy while the other one waits on the target disk
+                    self._threadedcopy.start(min(8, len(sources_dirs) * 2))
                     self._threadedcopy.wait()
                     self._threadedcopy.stop()
                     end = time()
                     duration = int(end - start)+1
-                    self.log_callback(f"\n++ Finished copying {self._threadedcopy.copied_file_count} of {self._threadedcopy.total_file_count} files in {duration}s. ++\n\n")
+                    identical = ""
+                    if self._threadedcopy.identical_file_count:
+                        identical = f" ({self._threadedcopy.identical_file_count} identical files skipped)"
+                    self.log_callback(f"\n++ Finished copying {self._threadedcopy.copied_file_count} of {self._threadedcopy.total_file_count} files{identical} in {duration}s. ++\n\n")
                 else:
                     self.log_callback("\n++ Finished. Nothing to copy. ++\n\n")
                 self.done_callback()
@@ -397,12 +630,10 @@ class BatchCopy():
 
     def _on_done_callback(self, event=None):
         if self._is_copy_thread_alive():
-            self.root.update_idletasks()
-            self.root.update()
-            sleep(0.1)
-        if self._copy_thread:
-            self._copy_thread.join(1)
-            self._copy_thread = None
+            # The copy thread sends the event right before it ends.
+            # Check again from the event loop instead of blocking the GUI while it finishes.
+            self.root.after(50, self._on_done_callback)
+            return
         self._stitcher = None
         self._can_quit = True
         if self.button_start:
@@ -422,12 +653,21 @@ class BatchCopy():
         try:
             # It's not safe to call tkinter directly from a different thread.
             # But we can send store the data temporarily and send a message to tkinter to process it.
+            # Only one event is pending at a time, messages logged in the meantime are picked up with it.
             try:
                 self._lock.acquire()
                 self._unprocessed_logs.append(text)
+                notify = not self._log_event_pending
+                self._log_event_pending = True
             finally:
                 self._lock.release()
-            self.root.event_generate("<<log_callback>>")
+            if notify:
+                try:
+                    self.root.event_generate("<<log_callback>>")
+                except Exception:
+                    # let the next message try again
+                    self._log_event_pending = False
+                    raise
         except Exception as e:
             print("Error in log_callback(): ", str(e))
 
@@ -437,22 +677,25 @@ class BatchCopy():
 
 
     def _on_log_callback(self, event=None):
-        if self.text_area:
-            try:
-                self._lock.acquire()
-                for text in self._unprocessed_logs:
-                    self.log(text)
-                self._unprocessed_logs.clear()
-            finally:
-                self._lock.release()
+        try:
+            self._lock.acquire()
+            texts = self._unprocessed_logs
+            self._unprocessed_logs = []
+            self._log_event_pending = False
+        finally:
+            self._lock.release()
+        if texts:
+            # one text widget update for the whole batch
+            self._insert_log("".join(text if text == "." else "\n" + text for text in texts))
 
     def log(self, text):
         # Only call from main gui thread
+        self._insert_log(text if text == "." else "\n" + text)
+
+    def _insert_log(self, text):
         try:
             if self.text_area:
                 self.text_area.configure(state=tk.NORMAL)
-                if text != ".":
-                    self.text_area.insert(tk.END, "\n")
                 self.text_area.insert(tk.END, text)
                 self.text_area.configure(state=tk.DISABLED)
         except Exception as e:
@@ -510,6 +753,8 @@ class BatchCopy():
         row += 1
         # self.button_cancel = ttk.Button(text='Cancel', command=self._on_cancel, width=self.button_width)
         # self.button_cancel.grid(row=row, column=0, columnspan=2, padx=(50, 0), pady=(20,50), sticky="w")
+        verify_check = ttk.Checkbutton(self.root, text='Compare content of existing files', variable=self.verify_value)
+        verify_check.grid(row=row, column=1, columnspan=2, padx=2, pady=(15,50), sticky="w")
         self.button_start = ttk.Button(text='Start', command=self._on_start, width=self.button_width)
         self.button_start.grid(row=row, column=3, columnspan=2, padx=(0, 50), pady=(15,50), sticky="e")
 
@@ -49,10 +49,20 @@ class Helpers:
                 total, used, free = shutil.disk_usage(f)
                 total_used += used
             else:
-                for path, dirs, files in os.walk(f):
-                    for f in files:
-                        fp = os.path.join(path, f)
-                        total_used += os.path.getsize(fp)
+                # sizes come from the directory entries, which usually needs no extra stat() call
+                stack = [f]
+                while stack:
+                    try:
+                        it = scandir(stack.pop())
+                    except OSError:
+                        # skip unreadable folders like os.walk() did
+                        continue
+                    with it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                total_used += entry.stat(follow_symlinks=False).st_size
         return total_used
 
     @staticmethod
@@ -77,15 +87,20 @@ class Helpers:
 
     @staticmethod
     def get_subdirs(path, startswith=None, sort=True):
+        """
+        Returns the names of subdirectories of path.
+        startswith can be a prefix or a tuple of prefixes, which are all tested in one pass.
+        """
         result = []
         if os.path.isdir(path):
-            for entry in scandir(path):
-                if entry.is_dir():
-                    if startswith:
-                        if entry.name.startswith(startswith):
+            with scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if startswith:
+                            if entry.name.startswith(startswith):
+                                result.append(entry.name)
+                        else:
                             result.append(entry.name)
-                    else:
-                        result.append(entry.name)
         if sort:
             return sorted(result)
         else: